@@ -1,10 +1,21 @@
 """Simple file to stand up a serial server.
 
 This is meant for hosting a stm32 flash binary.
+
+Transfers are bound by serial link latency, not CPU, so optimizations here
+focus on fewer round trips and syscalls: windowing, blksize negotiation and
+coalesced writes.
 """
+import collections
+import logging
+import mmap
+import os
 import serial
+import struct
 import sys
 
+log = logging.getLogger(__name__)
+
 
 class TftpServer:
     OPCODE_READ = b"\x00\x01"
@@ -12,23 +23,53 @@ class TftpServer:
     OPCODE_DATA = b"\x00\x03"
     OPCODE_ACK = b"\x00\x04"
     OPCODE_ERR = b"\x00\x05"
+    OPCODE_OACK = b"\x00\x06"
+
+    # ACKs are unpacked as (opcode, block) ints in a single call.
+    _ACK_STRUCT = struct.Struct(">HH")
+    _OP_ACK = 4
+
+    # How an ACK moved the window, see slide_window.
+    ACK_BAD = 0
+    ACK_STALE = 1
+    ACK_GOOD = 2
+    ACK_GAP = 3
 
     STATE_WAITING = 0
-    STATE_READING = 1
     STATE_WRITING = 2
     STATE_ERR = 3
 
-    tftp_block_size = 512
+    default_block_size = 512
+    max_block_size = 8192
+    tftp_block_size = default_block_size
+    default_window_size = 1
+    max_window_size = 64
+    window_size = default_window_size
+    first_block = 0
     write_no_ack_retry = 3
+    option_timeout = 0.05
     err_str = ""
-    file = None
 
 
     def __init__(self, file):
         self.file = file
 
+        # The image is mapped at the start of each transfer, see map_file.
+        self._mm = b""
+        self._pos = 0
+
+        # First and last block of the last resend in this transfer.
+        self._resent = None
+
+        self._handlers = {
+            self.STATE_WAITING: self._do_wait,
+            self.STATE_WRITING: self._do_write,
+            self.STATE_ERR: self._do_err,
+        }
+
 
     def __del__(self):
+        self.unmap_file()
         self.file.close()
 
 
@@ -43,146 +84,499 @@ class TftpServer:
         return input_string[0:2]
 
 
-    def parse_ack(self, given, expected_block):
-        valid_ack = given[0] == self.OPCODE_ACK
-        correct_block = given[1] == int(expected_block).to_bytes(2, 'big')
+    def parse_ack(self, given):
+        """Helper function to get the acked block number out of an ACK.
 
-        if valid_ack and correct_block:
-            return True
-        else:
+        @param self  The current object.
+        @param given The 4 byte packet read from the client.
+        @return      The acked block number, or None if given isn't an ACK.
+        """
+        if len(given) != 4:
+            print(f"Expected a 4 byte ACK. Got {given}")
+            return None
+
+        opcode, block = self._ACK_STRUCT.unpack(given)
+        if opcode != self._OP_ACK:
             print(
-                f"Expected opcode of {self.OPCODE_ACK}. Got opcode of {given[0]}"
+                f"Expected opcode of {self.OPCODE_ACK}. Got opcode of {opcode}"
             )
+            return None
+
+        return block
+
+
+    def slide_window(self, given, in_flight):
+        """Drop every in flight block covered by the given ACK.
+
+        ACKs are cumulative (RFC 7440), acking a block also acks every block
+        that was sent before it. A client that sees a gap re-acks the last
+        block it got in order, so an ACK short of the last block in flight
+        means the rest of the window has to be resent.
+
+        A repeat of the last acked block is only a gap when windowing. It is
+        how the client reports losing the first block of a window, and it is
+        acted on once. Resending on every repeat is the Sorcerer's
+        Apprentice bug (RFC 1123 4.2.3.1): the client re-acks the duplicate
+        blocks, which would trigger yet another resend. So repeats are stale
+        in lock-step transfers, where the timeout covers loss, and once the
+        window has been resent or the repeat answers blocks we resent.
+
+        @param self      The current object.
+        @param given     The 4 byte packet read from the client.
+        @param in_flight Deque of (block_counter, message) not yet acked.
+        @return          ACK_GOOD if every block in flight is acked, ACK_GAP
+                         if the remaining blocks need resending, ACK_STALE
+                         for an ACK outside the window and ACK_BAD if given
+                         isn't an ACK.
+        """
+        acked = self.parse_ack(given)
+        if acked is None:
+            return self.ACK_BAD
+
+        if not in_flight:
+            return self.ACK_STALE
+
+        # Block numbers on the wire wrap at 16 bits, so a repeat of the last
+        # acked block lands just below the window.
+        offset = (acked - in_flight[0][0]) & 0xFFFF
+        if offset == 0xFFFF:
+            log.debug("Duplicate acq on block %d", acked)
+            front = in_flight[0][0]
+            if self.window_size == 1 or (
+                self._resent is not None and
+                self._resent[0] <= front <= self._resent[1] + 1
+            ):
+                return self.ACK_STALE
+
+            return self.ACK_GAP
+
+        if offset >= len(in_flight):
             print(
-                f"Expected block counter of {expected_block}. Got block counter of {given[1]}"
+                f"Expected block counter in [{in_flight[0][0]}, "
+                f"{in_flight[-1][0]}]. Got block counter of {acked}"
             )
+            return self.ACK_STALE
 
+        for _ in range(offset + 1):
+            in_flight.popleft()
 
-    def wait_for_valid_ack(self, server, num_retries, block_counter, first_attempt):
-        attempt = first_attempt
-        for _ in range(num_retries):
-            if self.parse_ack((self.get_opcode(attempt), attempt[2:4]), block_counter):
-                print(f"Valid acq on block {block_counter}")
-                return True
+        log.debug("Valid acq on block %d", acked)
+        if in_flight:
+            return self.ACK_GAP
+
+        return self.ACK_GOOD
+
+
+    def poll_acks(self, server, in_flight):
+        """Slide the window on any ACKs that already arrived, without blocking.
+
+        @param self      The current object.
+        @param server    The serial server.
+        @param in_flight Deque of (block_counter, message) not yet acked.
+        @return          The result of the last ACK that moved or repeated
+                         the window, or ACK_STALE if there was none.
+        """
+        # Read every complete ACK that is waiting in one call rather than
+        # one read per ACK.
+        waiting = server.in_waiting
+        waiting -= waiting % 4
+        if not in_flight or not waiting:
+            return self.ACK_STALE
+
+        acks = server.read(waiting)
+        result = self.ACK_STALE
+        for i in range(0, len(acks), 4):
+            ack = self.slide_window(acks[i:i + 4], in_flight)
+            if ack in (self.ACK_GOOD, self.ACK_GAP):
+                result = ack
+
+        return result
+
+
+    def map_file(self):
+        """Map the current contents of the file for one transfer.
+
+        The image can be rebuilt in place between transfers, so it is mapped
+        again for each one and unmapped when the transfer ends. An open
+        mapping stops Windows from truncating or rewriting the file. Each
+        block is then a slice instead of a read() call. An empty file can't
+        be mapped, so fall back to an empty buffer for it.
+
+        The trade-off is that truncating the file while a transfer is running
+        makes the next slice past the new end raise SIGBUS and kill the
+        server, where read() would have returned a short block. Don't
+        rebuild the image mid-transfer.
+
+        @param self The current object.
+        """
+        self.unmap_file()
+
+        if os.fstat(self.file.fileno()).st_size:
+            self._mm = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+
+    def unmap_file(self):
+        """Drop the mapping made by map_file, if there is one.
+
+        @param self The current object.
+        """
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._mm = b""
+
+
+    def frame_data(self, block_counter):
+        """Read the next block of the file and frame it as a DATA packet.
+
+        @param self          The current object.
+        @param block_counter The block number of the packet.
+        @return              The DATA packet and the size of its payload.
+        """
+        read_block = self._mm[self._pos:self._pos + self.tftp_block_size]
+        self._pos += len(read_block)
+
+        # Frame our message with the correct opcode and block counter in a
+        # single copy.
+        message = b"".join((
+            self.OPCODE_DATA,
+            (block_counter & 0xFFFF).to_bytes(2, 'big'),
+            read_block,
+        ))
+
+        return message, len(read_block)
+
+
+    def option_value(self, options, name, minimum, maximum):
+        """Helper function to get a numeric option from a read request.
+
+        @param self    The current object.
+        @param options Dict of option name to value from the request.
+        @param name    The option to look up.
+        @param minimum The smallest value the option's RFC allows.
+        @param maximum The largest value we are willing to use.
+        @return        The value capped at maximum, or None if the option is
+                       missing or invalid.
+        """
+        try:
+            value = int(options[name])
+        except (KeyError, ValueError):
+            return None
+
+        if value < minimum:
+            return None
 
-            attempt = server.read(4)
+        return min(value, maximum)
 
-        # If we got here, then we failed to acq the block.
+
+    def negotiate_options(self, server):
+        """Read the rest of a read request and acknowledge its options.
+
+        The blksize (RFC 2348) and windowsize (RFC 7440) options are
+        supported, any other options are ignored as RFC 2347 allows. Clients
+        that don't ask for any of them don't get an OACK and keep the default
+        block size and lock-step transfers.
+
+        @param self   The current object.
+        @param server The serial server.
+        @return       True if the client is ready for the first data block.
+        """
+        self.tftp_block_size = self.default_block_size
+        self.window_size = self.default_window_size
+        self.first_block = 0
+
+        # The rest of the request is filename\0mode\0[option\0value\0]*.
+        # Some clients only send the opcode, so if no filename follows it
+        # within option_timeout there is nothing more to read. Nothing marks
+        # the end of the options either, so once the mode is in keep reading
+        # fields until the line goes quiet for option_timeout.
+        server.timeout = self.option_timeout
+        filename = server.read_until(b"\0")
+
+        mode = b""
+        if filename.endswith(b"\0"):
+            server.timeout = 1
+            mode = server.read_until(b"\0")
+
+        fields = []
+        if mode.endswith(b"\0"):
+            server.timeout = self.option_timeout
+            server.inter_byte_timeout = self.option_timeout
+            while True:
+                field = server.read_until(b"\0")
+                if not field.endswith(b"\0"):
+                    break
+                fields.append(field[:-1])
+            server.inter_byte_timeout = None
+
+        options = {
+            name.lower(): value
+            for name, value in zip(fields[0::2], fields[1::2])
+        }
+
+        block_size = self.option_value(
+            options, b"blksize", 8, self.max_block_size
+        )
+        window_size = self.option_value(
+            options, b"windowsize", 1, self.max_window_size
+        )
+
+        accepted = []
+        if block_size is not None:
+            accepted += [b"blksize", str(block_size).encode("ascii")]
+        if window_size is not None:
+            accepted += [b"windowsize", str(window_size).encode("ascii")]
+
+        if not accepted:
+            return True
+
+        message = self.OPCODE_OACK
+        message += b"".join(field + b"\0" for field in accepted)
+
+        # The client acks the OACK as block 0 and the data starts at block 1
+        # (RFC 2347).
+        server.timeout = 2
+        for _ in range(self.write_no_ack_retry):
+            server.write(message)
+            if self.parse_ack(server.read(4)) == 0:
+                self.first_block = 1
+                if block_size is not None:
+                    print(f"Negotiated a block size of {block_size}")
+                    self.tftp_block_size = block_size
+                if window_size is not None:
+                    print(f"Negotiated a window size of {window_size}")
+                    self.window_size = window_size
+                return True
+
+        self.err_str = "Never received acq for the OACK"
         return False
 
+
+    def _do_wait(self, server):
+        """The waiting state, between read requests and after handling errors.
+
+        @param self   The current object.
+        @param server The serial server.
+        @return       The next state.
+        """
+        # Set the timeout to None to wait indefinitaly for the next
+        # RRQ.
+        server.timeout = None
+
+        # Wait on the opcode to dictate what we should do here.
+        server_request = server.read(2)
+        opcode = self.get_opcode(server_request)
+
+        # This is a read request. As the server, we should transfer to
+        # the writing state to fulfill the client's read request.
+        if opcode == self.OPCODE_READ:
+            print(f"Recieved read request for {self.file}!")
+            if self.negotiate_options(server):
+                return self.STATE_WRITING
+
+            return self.STATE_ERR
+
+        # This is a write request. As the server, we should never
+        # expect this. We should throw an unimplemented error as this
+        # was most likely a client side issue.
+        elif opcode == self.OPCODE_WRITE:
+            print(
+                f"Got an unexpected opcode of {opcode} in the waiting"
+                " state. Throwing err :("
+            )
+            self.err_str = f"Requested opcode {opcode} is" \
+                           f"unimplemented"
+            return self.STATE_ERR
+
+        # Throw and error if have an expect opcode for this state.
+        else:
+            server.timeout = 1
+            server_request += server.read_until('\n')
+            server.timeout = None
+
+            print(f"{server_request}")
+
+        return self.STATE_WAITING
+
+
+    def _do_write(self, server):
+        """The writing state. Send the desired file out the serial server.
+
+        @param self   The current object.
+        @param server The serial server.
+        @return       The next state.
+        """
+        self.map_file()
+        try:
+            return self.send_file(server)
+        finally:
+            self.unmap_file()
+
+
+    def send_file(self, server):
+        """Send the mapped file to the client in windows of DATA packets.
+
+        @param self   The current object.
+        @param server The serial server.
+        @return       The next state.
+        """
+        # Reset the block counter and set the timeout to 2s, this is
+        # how long we will wait for an acq once the window is full.
+        server.timeout = 2
+        block_counter = self.first_block
+        retries = 0
+        in_flight = collections.deque()
+        pending = None
+        resend = False
+        self._resent = None
+        self._pos = 0
+        print("Starting write")
+
+        # Hoist everything the per-block loop touches into locals, the loop
+        # runs once per block so attribute lookups add up.
+        block_size = self.tftp_block_size
+        window_size = self.window_size
+        frame_data = self.frame_data
+        debug = log.isEnabledFor(logging.DEBUG)
+
+        # If the last read size of the file is less than the tftp
+        # block size, we are at the end of the file and only have to
+        # wait for the outstanding blocks to be acked.
+        last_read_block_size = block_size
+        while last_read_block_size == block_size or in_flight:
+            # Resend whatever the client is missing and keep up to
+            # window_size blocks in flight before waiting on the client.
+            # Everything goes out in a single write.
+            if resend or (len(in_flight) < window_size and
+                          last_read_block_size == block_size):
+                # The window still holds the unacked blocks framed, so
+                # resending them doesn't touch the file.
+                burst = []
+                resent = resend
+                if resend:
+                    burst = [message for _, message in in_flight]
+                    resend = False
+
+                while (len(in_flight) < window_size and
+                        last_read_block_size == block_size):
+                    if pending is None:
+                        pending = frame_data(block_counter)
+                    message, last_read_block_size = pending
+                    pending = None
+
+                    # Log the message we want to send in hex. Skip
+                    # building the dump unless it will be shown.
+                    if debug:
+                        log.debug("sending message")
+                        log.debug("%s", message.hex(' '))
+
+                    burst.append(message)
+                    in_flight.append((block_counter, message))
+                    block_counter += 1
+
+                # Write our messages.
+                server.write(b"".join(burst))
+                if resent:
+                    self._resent = (in_flight[0][0], block_counter - 1)
+
+                ack = self.poll_acks(server, in_flight)
+                if ack in (self.ACK_GOOD, self.ACK_GAP):
+                    retries = 0
+                resend = ack == self.ACK_GAP
+                continue
+
+            # The window is full or we hit the end of the file, block
+            # until the client acks something. Frame the next block
+            # first so the file read overlaps the wait on the link.
+            if (pending is None and
+                    last_read_block_size == block_size):
+                pending = frame_data(block_counter)
+
+            acq = server.read(4)
+            ack = self.slide_window(acq, in_flight)
+
+            # The client is missing blocks, resend them straight away. It is
+            # still talking to us, so this doesn't count as a retry.
+            if ack == self.ACK_GAP:
+                retries = 0
+                resend = True
+                continue
+
+            if ack == self.ACK_GOOD:
+                retries = 0
+                continue
+
+            # A late or repeated ACK from before the window, the client is
+            # still there.
+            if ack == self.ACK_STALE:
+                continue
+
+            retries += 1
+            if retries >= self.write_no_ack_retry:
+                self.err_str = (
+                    f"Never received acq for block {in_flight[0][0]}"
+                )
+                return self.STATE_ERR
+
+            # On a timeout, resend everything from the oldest unacked
+            # block.
+            if len(acq) < 4:
+                resend = True
+
+        return self.STATE_WAITING
+
+
+    def _do_err(self, server):
+        """The error state. Report err_str to the client.
+
+        @param self   The current object.
+        @param server The serial server.
+        @return       The next state.
+        """
+        # Error code 0 (not defined, see message) followed by the NUL
+        # terminated message, as laid out in RFC 1350.
+        message = b"".join((
+            self.OPCODE_ERR,
+            b"\x00\x00",
+            self.err_str.encode("ascii", "replace"),
+            b"\x00",
+        ))
+        server.write(message)
+        self.err_str = ""
+
+        return self.STATE_WAITING
+
+
     def run_sm(self, server):
         current_state = self.STATE_WAITING
 
         while(1):
-            # The waiting state where we should go to between read requests
-            # and after handling errors.
-            if current_state == self.STATE_WAITING:
-                # Set the timeout to None to wait indefinitaly for the next
-                # RRQ.
-                server.timeout = None
-
-                # Wait on the opcode to dictate what we should do here.
-                server_request = server.read(2)
-                opcode = self.get_opcode(server_request)
-
-                # This is a read request. As the server, we should transfer to
-                # the writing state to fulfill the client's read request.
-                if opcode == self.OPCODE_READ:
-                    print(f"Recieved read request for {self.file}!")
-                    current_state = self.STATE_WRITING
-
-                # This is a write request. As the server, we should never
-                # expect this. We should throw an unimplemented error as this
-                # was most likely a client side issue.
-                elif opcode == self.OPCODE_WRITE:
-                    print(
-                        f"Got an unexpected opcode of {opcode} in the waiting"
-                        " state. Throwing err :("
-                    )
-                    self.err_str = f"Requested opcode {opcode} is" \
-                                   f"unimplemented"
-                    current_state = self.STATE_ERR
-
-                # Throw and error if have an expect opcode for this state.
-                else:
-                    server.timeout = 1
-                    server_request += server.read_until('\n')
-                    server.timeout = None
-
-                    print(f"{server_request}")
-
-            # The writing state. Send the desired file to out the serial
-            # server.
-            elif current_state == self.STATE_WRITING:
-                # Reset the block counter and set the timeout to 2s, this is
-                # how long we will wait for an acq for each data block.
-                server.timeout = 2
-                block_counter = 0
-                print("Starting write")
-
-                # If the last read size of the file is less than the tftp
-                # block size, we are at the end of the file and now can move
-                # on.
-                last_read_block_size = self.tftp_block_size
-                while last_read_block_size == self.tftp_block_size:
-                    # Frame our message with the correct opcode and block
-                    # counter.
-                    print("sending message")
-                    message = self.OPCODE_DATA
-                    message += block_counter.to_bytes(2, 'big')
-
-                    read_block = self.file.read(self.tftp_block_size)
-                    last_read_block_size = len(read_block)
-
-                    message += last_read_block_size.to_bytes(2, 'big')
-                    message += read_block
-
-                    # Print out the message we want to send in hex
-                    print(''.join('{:02x} '.format(x) for x in message))
-
-                    # Write our message.
-                    server.write(message)
-
-                    acq = server.read(4)
-                    # rply = server.read(last_read_block_size)
-
-                    # print("recived this from the client")
-                    # print(''.join('{:02x} '.format(x) for x in rply))
-
-                    if self.wait_for_valid_ack(
-                        server, self.write_no_ack_retry, block_counter, acq
-                    ):
-                        block_counter += 1
-                    else:
-                        current_state = self.STATE_ERR
-                        self.err_str = (
-                            f"Never received acq for block {block_counter}"
-                        )
-
-                if current_state == self.STATE_WRITING:
-                    current_state = self.STATE_WAITING
-
-            elif current_state == self.STATE_ERR:
-                message = str(self.OPCODE_ERR)
-                message += str(0) + str(0)
-                message += self.err_str
-                server.write(message)
-                self.err_str = ""
-
-                current_state = self.STATE_WAITING
-
-            else:
-                print(f"Hit unimplemented state {current_state}")
-                self.err_str = f"Hit unimplemented state {current_state}"
-
-                current_state = self.STATE_ERR
+            current_state = self._handlers[current_state](server)
 
 
 def main(*args):
+    logging.basicConfig(level=logging.INFO)
+
     usb_device_name = "/dev/tty.usbmodem2103"
     serial_baud_rate = 115200
     try:
-        server = serial.Serial(usb_device_name, serial_baud_rate)
+        # Turn off flow control explicitly so the driver never stalls a
+        # write waiting on CTS/DSR or XON, and don't arm a write timer.
+        server = serial.Serial(
+            usb_device_name,
+            serial_baud_rate,
+            rtscts=False,
+            xonxoff=False,
+            dsrdtr=False,
+            write_timeout=None,
+            timeout=None,
+        )
+
+        # Windows defaults to small driver buffers, make room for a whole
+        # window of blocks.
+        if sys.platform == "win32":
+            server.set_buffer_size(rx_size=131072, tx_size=131072)
 
         # Close the server before opening to be sure that the call to "open"
         # doesn't fail.
@@ -0,0 +1,357 @@
+"""Behaviour tests for the TFTP serial server against a fake client."""
+import collections
+import tempfile
+import unittest
+
+import serial_server
+
+
+class FakeClient:
+    """Stand in for the serial port that plays an RFC 7440 TFTP client.
+
+    Bytes queued in rx are what the server reads. Everything the server
+    writes is parsed as TFTP packets and answered the way a client would.
+    On a slow link in_waiting is always 0, so the server never sees an ACK
+    until it blocks on a read, after its next window has gone out.
+    """
+
+    def __init__(self, request, drop=(), duplicate_acks=(), slow_link=False):
+        self.rx = bytearray(request)
+        self.slow_link = slow_link
+        self.timeout = None
+        self.block_size = 512
+        self.window_size = 1
+        self.expected = 0
+        self.in_window = 0
+        self.gap_acked = False
+        self.drop = set(drop)
+        self.duplicate_acks = set(duplicate_acks)
+        self.received = bytearray()
+        self.blocks = []
+        self.oacks = []
+        self.errors = []
+        self.short_reads = 0
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        if self.slow_link:
+            return 0
+        return len(self.rx)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        self.reads += 1
+        if len(data) < size:
+            self.short_reads += 1
+        return data
+
+    def read_until(self, expected=b"\n", size=None):
+        line = bytearray()
+        while not line.endswith(expected):
+            c = self.read(1)
+            if not c:
+                break
+            line += c
+        return bytes(line)
+
+    def ack(self, block):
+        self.rx += b"\x00\x04" + (block & 0xFFFF).to_bytes(2, 'big')
+
+    def write(self, data):
+        data = bytes(data)
+        while data:
+            opcode = data[:2]
+            if opcode == b"\x00\x05":
+                self.errors.append(data)
+                return
+
+            if opcode == b"\x00\x06":
+                self.oacks.append(data)
+                fields = data[2:].split(b"\x00")
+                options = dict(zip(fields[0::2], fields[1::2]))
+                self.block_size = int(options.get(b"blksize", 512))
+                self.window_size = int(options.get(b"windowsize", 1))
+                self.expected = 1
+                self.ack(0)
+                return
+
+            size = min(self.block_size, len(data) - 4)
+            self.receive(
+                int.from_bytes(data[2:4], 'big'), data[4:4 + size]
+            )
+            data = data[4 + size:]
+
+    def receive(self, block, payload):
+        self.blocks.append(block)
+        if block in self.drop:
+            self.drop.discard(block)
+            return
+
+        # Out of order, re-ack the last block we got once and wait for the
+        # server to resend.
+        if block != self.expected & 0xFFFF:
+            if not self.gap_acked:
+                self.gap_acked = True
+                self.in_window = 0
+                self.ack(self.expected - 1)
+            return
+
+        self.gap_acked = False
+        self.received += payload
+        self.expected += 1
+        self.in_window += 1
+        if (self.in_window == self.window_size or
+                len(payload) < self.block_size):
+            self.in_window = 0
+            self.ack(block)
+            if block in self.duplicate_acks:
+                self.ack(block)
+
+
+class TftpServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = bytes(range(256)) * 80 + b"tail"
+        self.file = tempfile.TemporaryFile()
+        self.file.write(self.image)
+        self.file.flush()
+        self.server = serial_server.TftpServer(self.file)
+
+    def transfer(self, client):
+        state = self.server._do_wait(client)
+        self.assertEqual(state, self.server.STATE_WRITING)
+        return self.server._do_write(client)
+
+    def test_clean_transfer(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.oacks, [])
+        self.assertEqual(client.blocks, list(range(41)))
+
+    def test_windowed_transfer(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00blksize\x00256\x00windowsize\x004\x00"
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.blocks, list(range(1, 82)))
+
+    def test_lost_block_mid_window_is_resent(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00windowsize\x008\x00", drop={5}
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.blocks.count(5), 2)
+        self.assertEqual(client.errors, [])
+
+    def test_lost_first_block_of_window_is_resent(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00windowsize\x004\x00", drop={9}
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.blocks.count(9), 2)
+
+    def test_lost_block_without_window_is_resent(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00", drop={5})
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.blocks.count(5), 2)
+
+    def test_duplicate_ack_without_window_is_ignored(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00",
+            duplicate_acks={4},
+            slow_link=True,
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.blocks, list(range(41)))
+
+    def test_duplicate_ack_with_window_resends_once(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00windowsize\x004\x00",
+            duplicate_acks={4},
+            slow_link=True,
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.errors, [])
+
+        # Only the window after the repeated ACK goes out twice, the
+        # client's re-acks of those duplicates don't start another resend.
+        resent = [
+            block for block in set(client.blocks)
+            if client.blocks.count(block) > 1
+        ]
+        self.assertEqual(sorted(resent), [5, 6, 7, 8])
+        self.assertEqual(len(client.blocks), 41 + 4)
+
+    def test_opcode_only_request(self):
+        client = FakeClient(b"\x00\x01")
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(bytes(client.received), self.image)
+        self.assertEqual(client.oacks, [])
+
+        # Only the missing filename waits out a timeout, not the mode too.
+        self.assertEqual(client.short_reads, 1)
+
+    def test_request_without_options(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+
+        self.assertEqual(
+            self.server._do_wait(client), self.server.STATE_WRITING
+        )
+        self.assertEqual(client.oacks, [])
+        self.assertEqual(self.server.tftp_block_size, 512)
+        self.assertEqual(self.server.window_size, 1)
+
+    def test_oack_ack_starts_data_at_block_one(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00blksize\x001024\x00")
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(client.oacks, [b"\x00\x06blksize\x001024\x00"])
+        self.assertEqual(client.blocks[0], 1)
+        self.assertEqual(bytes(client.received), self.image)
+
+    def test_oack_caps_options(self):
+        client = FakeClient(
+            b"\x00\x01fw.bin\x00octet\x00"
+            b"BLKSIZE\x0065464\x00windowsize\x001000\x00tsize\x000\x00"
+        )
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(
+            client.oacks,
+            [b"\x00\x06blksize\x008192\x00windowsize\x0064\x00"],
+        )
+        self.assertEqual(bytes(client.received), self.image)
+
+    def test_oack_never_acked(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00blksize\x001024\x00")
+        client.ack = lambda block: None
+
+        self.assertEqual(
+            self.server._do_wait(client), self.server.STATE_ERR
+        )
+        self.assertEqual(len(client.oacks), self.server.write_no_ack_retry)
+
+    def test_image_rebuilt_between_transfers(self):
+        for image in (b"short image", self.image * 2):
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(image)
+            self.file.flush()
+
+            client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+            self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+            self.assertEqual(bytes(client.received), image)
+
+    def test_mapping_released_after_transfer(self):
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(self.server._mm, b"")
+
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+        client.ack = lambda block: None
+        self.assertEqual(self.transfer(client), self.server.STATE_ERR)
+        self.assertEqual(self.server._mm, b"")
+
+    def test_empty_image(self):
+        self.file.truncate(0)
+        client = FakeClient(b"\x00\x01fw.bin\x00octet\x00")
+
+        self.assertEqual(self.transfer(client), self.server.STATE_WAITING)
+        self.assertEqual(client.blocks, [0])
+        self.assertEqual(bytes(client.received), b"")
+
+    def test_parse_ack(self):
+        self.assertEqual(self.server.parse_ack(b"\x00\x04\x01\x02"), 0x102)
+
+    def test_parse_ack_short_read(self):
+        self.assertIsNone(self.server.parse_ack(b""))
+        self.assertIsNone(self.server.parse_ack(b"\x00\x04\x00"))
+
+    def test_parse_ack_wrong_opcode(self):
+        self.assertIsNone(self.server.parse_ack(b"\x00\x03\x00\x01"))
+        self.assertIsNone(self.server.parse_ack(b"\x00\x05\x00\x00"))
+
+    def test_error_packet(self):
+        client = FakeClient(b"")
+        self.server.err_str = "Never received acq for block 3"
+
+        self.assertEqual(
+            self.server._do_err(client), self.server.STATE_WAITING
+        )
+        self.assertEqual(
+            client.errors,
+            [b"\x00\x05\x00\x00Never received acq for block 3\x00"],
+        )
+        self.assertEqual(self.server.err_str, "")
+
+    def test_write_request_is_an_error(self):
+        client = FakeClient(b"\x00\x02fw.bin\x00octet\x00")
+
+        self.assertEqual(
+            self.server._do_wait(client), self.server.STATE_ERR
+        )
+        self.server._do_err(client)
+        self.assertEqual(len(client.errors), 1)
+        self.assertTrue(client.errors[0].startswith(b"\x00\x05\x00\x00"))
+        self.assertTrue(client.errors[0].endswith(b"\x00"))
+
+    def in_flight(self, *blocks):
+        return collections.deque((block, b"") for block in blocks)
+
+    def test_poll_acks_drains_in_one_read(self):
+        client = FakeClient(b"")
+        for block in (0, 1, 2):
+            client.ack(block)
+        client.rx += b"\x00\x04"
+        in_flight = self.in_flight(0, 1, 2, 3)
+
+        self.assertEqual(
+            self.server.poll_acks(client, in_flight), self.server.ACK_GAP
+        )
+        self.assertEqual(client.reads, 1)
+        self.assertEqual([block for block, _ in in_flight], [3])
+
+        # The half ACK is left for the next poll.
+        self.assertEqual(bytes(client.rx), b"\x00\x04")
+
+    def test_poll_acks_whole_window(self):
+        client = FakeClient(b"")
+        client.ack(1)
+        client.ack(3)
+        in_flight = self.in_flight(0, 1, 2, 3)
+
+        self.assertEqual(
+            self.server.poll_acks(client, in_flight), self.server.ACK_GOOD
+        )
+        self.assertEqual(len(in_flight), 0)
+
+    def test_poll_acks_nothing_waiting(self):
+        client = FakeClient(b"\x00\x04")
+        in_flight = self.in_flight(0)
+
+        self.assertEqual(
+            self.server.poll_acks(client, in_flight), self.server.ACK_STALE
+        )
+        self.assertEqual(client.reads, 0)
+        self.assertEqual(len(in_flight), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()